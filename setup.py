@@ -15,7 +15,6 @@ INSTALL_REQUIRES = [
 CHOOSE_CRYPTO_LIB = [
     'cryptography',  # pyca/cryptography - https://cryptography.io/en/latest/
     'pycryptodome',  # PyCryptodome      - https://pycryptodome.readthedocs.io/en/latest/
-    'pyaes',         # pyaes             - https://github.com/ricmoo/pyaes
     'pycrypto',      # PyCrypto          - https://www.pycrypto.org/
 ]
 
@@ -4,13 +4,16 @@ import logging
 
 import unittest
 try:
-    from unittest.mock import MagicMock  # Python 3
+    from unittest.mock import MagicMock, patch  # Python 3
 except ImportError:
-    from mock import MagicMock  # py2 use https://pypi.python.org/pypi/mock
+    from mock import MagicMock, patch  # py2 use https://pypi.python.org/pypi/mock
 from hashlib import md5
 import json
 import logging
 import struct
+import select
+import socket
+import threading
 
 # Enable info logging to see version information
 log = logging.getLogger('tinytuya')
@@ -19,6 +22,7 @@ log.setLevel(level=logging.INFO)
 log.setLevel(level=logging.DEBUG)  # Debug hack!
 
 import tinytuya
+import tinytuya.scanner
 
 LOCAL_KEY = '0123456789abcdef'
 
@@ -192,5 +196,55 @@ class TestXenonDevice(unittest.TestCase):
 
         self.assertEqual(result['test_result'], "SUCCESS")
 
+class TestScanner(unittest.TestCase):
+    def test_poll_closed_connection(self):
+        # a device which reads the poll and then hangs up must not leave select() spinning
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        server.settimeout(0.5)
+        running = [True]
+
+        def serve():
+            while running[0]:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+                conn.settimeout(1)
+                try:
+                    conn.recv(5000)
+                except socket.timeout:
+                    pass
+                conn.close()
+
+        thrd = threading.Thread(target=serve)
+        thrd.daemon = True
+        thrd.start()
+
+        select_calls = [0]
+        real_select = select.select
+        def counting_select(*args):
+            select_calls[0] += 1
+            return real_select(*args)
+
+        snapshot = {'127.0.0.1': {'ip': '127.0.0.1', 'gwId': 'DEVICE_ID_HERE', 'key': LOCAL_KEY, 'version': 3.3, 'name': 'Test'}}
+        old_port = tinytuya.scanner.TCPPORT
+        tinytuya.scanner.TCPPORT = server.getsockname()[1]
+        try:
+            with patch('select.select', side_effect=counting_select):
+                tinytuya.scanner.devices(verbose=False, scantime=2, color=False, discover=False, snapshot=snapshot, assume_yes=True)
+        finally:
+            tinytuya.scanner.TCPPORT = old_port
+            running[0] = False
+            server.close()
+            thrd.join()
+
+        # ~10 passes per second for a few seconds, a busy-loop racks up many thousands
+        self.assertLess(select_calls[0], 1000)
+
 if __name__ == '__main__':
     unittest.main()
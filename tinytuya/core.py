@@ -75,8 +75,8 @@ from hashlib import md5,sha256
 import hmac
 import json
 import logging
+import os
 import socket
-import select
 import struct
 import sys
 import time
@@ -110,6 +110,10 @@ for clib in ('pyca/cryptography', 'PyCryptodomex', 'PyCrypto', 'pyaes'):
             # v1/v2 is PyCrypto, v3 is PyCryptodome
             clib = 'PyCrypto' if Crypto.version_info[0] < 3 else 'PyCryptodome'
         elif clib == 'pyaes':
+            # pyaes is pure-Python and several orders of magnitude slower than the
+            #  C-backed libraries above, so only use it if explicitly allowed
+            if os.environ.get('TINYTUYA_ALLOW_PYAES', '') != '1':
+                continue
             import pyaes  # https://github.com/ricmoo/pyaes
         else:
             continue
@@ -118,7 +122,7 @@ for clib in ('pyca/cryptography', 'PyCryptodomex', 'PyCrypto', 'pyaes'):
     except ImportError:
         continue
 if CRYPTOLIB is None:
-    raise ModuleNotFoundError('No crypto library found, please "pip install" cryptography, pycryptodome, or pyaes')
+    raise ModuleNotFoundError('No crypto library found, please "pip install" cryptography or pycryptodome (pyaes can be used by setting TINYTUYA_ALLOW_PYAES=1)')
 
 # Colorama terminal color capability for all platforms
 init()
@@ -254,6 +258,13 @@ class DecodeError(Exception):
 class _AESCipher_Base(object):
     def __init__(self, key):
         self.key = key
+        self._ecb = None
+
+    def _get_ecb(self):
+        # ECB has no IV/nonce, so the cipher context only needs to be built once
+        if self._ecb is None:
+            self._ecb = self._new_ecb()
+        return self._ecb
 
     @classmethod
     def get_encryption_iv( cls, iv ):
@@ -290,6 +301,9 @@ class _AESCipher_Base(object):
         return s[:-padlen]
 
 class _AESCipher_pyca(_AESCipher_Base):
+    def _new_ecb(self):
+        return Crypto( AES(self.key), Crypto_modes.ECB() )
+
     def encrypt(self, raw, use_base64=True, pad=True, iv=False, header=None): # pylint: disable=W0621
         if iv: # initialization vector or nonce (number used once)
             iv = self.get_encryption_iv( iv )
@@ -300,7 +314,7 @@ class _AESCipher_pyca(_AESCipher_Base):
             crypted_text = iv + crypted_text + encryptor.tag
         else:
             if pad: raw = self._pad(raw, 16)
-            encryptor = Crypto( AES(self.key), Crypto_modes.ECB() ).encryptor()
+            encryptor = self._get_ecb().encryptor()
             crypted_text = encryptor.update(raw) + encryptor.finalize()
 
         return base64.b64encode(crypted_text) if use_base64 else crypted_text
@@ -321,12 +335,15 @@ class _AESCipher_pyca(_AESCipher_Base):
                 decryptor.authenticate_additional_data( header )
             raw = decryptor.update( enc ) + decryptor.finalize()
         else:
-            decryptor = Crypto( AES(self.key), Crypto_modes.ECB() ).decryptor()
+            decryptor = self._get_ecb().decryptor()
             raw = decryptor.update( enc ) + decryptor.finalize()
             raw = self._unpad(raw, verify_padding)
         return raw.decode("utf-8") if decode_text else raw
 
 class _AESCipher_PyCrypto(_AESCipher_Base):
+    def _new_ecb(self):
+        return AES.new(self.key, mode=AES.MODE_ECB)
+
     def encrypt(self, raw, use_base64=True, pad=True, iv=False, header=None): # pylint: disable=W0621
         if iv: # initialization vector or nonce (number used once)
             iv = self.get_encryption_iv( iv )
@@ -337,8 +354,7 @@ class _AESCipher_PyCrypto(_AESCipher_Base):
             crypted_text = cipher.nonce + crypted_text + tag
         else:
             if pad: raw = self._pad(raw, 16)
-            cipher = AES.new(self.key, mode=AES.MODE_ECB)
-            crypted_text = cipher.encrypt(raw)
+            crypted_text = self._get_ecb().encrypt(raw)
 
         return base64.b64encode(crypted_text) if use_base64 else crypted_text
 
@@ -358,12 +374,15 @@ class _AESCipher_PyCrypto(_AESCipher_Base):
             else:
                 raw = cipher.decrypt(enc)
         else:
-            cipher = AES.new(self.key, AES.MODE_ECB)
-            raw = cipher.decrypt(enc)
+            raw = self._get_ecb().decrypt(enc)
             raw = self._unpad(raw, verify_padding)
         return raw.decode("utf-8") if decode_text else raw
 
 class _AESCipher_pyaes(_AESCipher_Base):
+    def _new_ecb(self):
+        # pylint: disable-next=used-before-assignment
+        return pyaes.AESModeOfOperationECB(self.key)
+
     def encrypt(self, raw, use_base64=True, pad=True, iv=False, header=None): # pylint: disable=W0621
         if iv:
             # GCM required for 3.5 devices
@@ -371,7 +390,7 @@ class _AESCipher_pyaes(_AESCipher_Base):
 
         # pylint: disable-next=used-before-assignment
         cipher = pyaes.blockfeeder.Encrypter(
-            pyaes.AESModeOfOperationECB(self.key),
+            self._get_ecb(),
             pyaes.PADDING_DEFAULT if pad else pyaes.PADDING_NONE
         )  # no IV, auto pads to 16
         crypted_text = cipher.feed(raw)
@@ -390,7 +409,7 @@ class _AESCipher_pyaes(_AESCipher_Base):
             raise ValueError("invalid length")
 
         cipher = pyaes.blockfeeder.Decrypter(
-            pyaes.AESModeOfOperationECB(self.key),
+            self._get_ecb(),
             pyaes.PADDING_NONE if verify_padding else pyaes.PADDING_DEFAULT
         )  # no IV, auto pads to 16
 
@@ -1966,6 +1985,11 @@ def decrypt(msg, key):
 
 # UDP packet payload decryption - credit to tuya-convert
 udpkey = md5(b"yGAdlopoPVldABfn").digest()
+# every broadcast uses the same key, so share one cipher across all packets
+_udp_cipher = AESCipher( udpkey )
+
+def _decrypt_udp_ecb(msg):
+    return _udp_cipher.decrypt( msg, use_base64=False, decode_text=True )
 
 def decrypt_udp(msg):
     try:
@@ -1973,23 +1997,22 @@ def decrypt_udp(msg):
     except:
         header = None
     if not header:
-        return decrypt(msg, udpkey)
+        return _decrypt_udp_ecb(msg)
+    # hand the already-parsed header to unpack_message() so it does not parse it again
     if header.prefix == PREFIX_55AA_VALUE:
-        payload = unpack_message(msg).payload
+        payload = unpack_message(msg, header=header).payload
         try:
             if payload[:1] == b'{' and payload[-1:] == b'}':
                 return payload.decode()
         except:
             pass
-        return decrypt(payload, udpkey)
+        return _decrypt_udp_ecb(payload)
     if header.prefix == PREFIX_6699_VALUE:
-        unpacked = unpack_message(msg, hmac_key=udpkey, no_retcode=None)
+        unpacked = unpack_message(msg, hmac_key=udpkey, header=header, no_retcode=None)
         payload = unpacked.payload.decode()
         # app sometimes has extra bytes at the end
-        while payload[-1] == chr(0):
-            payload = payload[:-1]
-        return payload
-    return decrypt(msg, udpkey)
+        return payload.rstrip(chr(0))
+    return _decrypt_udp_ecb(msg)
 
 
 def appenddevice(newdevice, devices):
@@ -18,8 +18,10 @@ from collections import namedtuple
 import ipaddress
 import json
 import logging
+import os
 import socket
 import select
+import struct
 import sys
 import time
 import errno
@@ -53,6 +55,13 @@ try:
 except ImportError:
     PSULIBS = False
 
+# Optional faster JSON library
+try:
+    import orjson # pylint: disable=E0401
+    ORJSONLIB = True
+except ImportError:
+    ORJSONLIB = False
+
 # Colorama terminal color capability for all platforms
 init()
 
@@ -71,14 +80,18 @@ UDPPORTAPP = tinytuya.UDPPORTAPP    # Tuya app encrypted UDP Port
 TIMEOUT = tinytuya.TIMEOUT          # Socket Timeout
 SCANTIME = tinytuya.SCANTIME        # How many seconds to wait before stopping
 BROADCASTTIME = 6                   # How often to broadcast to port 7000 to get v3.5 devices to send us their info
+UDPRCVBUF = 4 * 1024 * 1024         # Receive buffer size to request for the UDP listeners
 
 max_parallel = 300
+max_connects_per_pass = 50          # How many new force-scan connections to open each time through the select() loop
+max_datagrams_per_pass = 64         # How many queued UDP packets to read from each listener each time through the select() loop
 connect_timeout = 3
 
 devinfo_keys = ('ip', 'mac', 'name', 'key', 'gwId', 'active', 'ability', 'encrypt', 'productKey', 'version', 'token', 'wf_cfg' )
 # id ver
 
 TermColors = namedtuple("TermColors", "bold, subbold, normal, dim, alert, alertdim, cyan, red, yellow")
+_termcolors_cache = {}
 
 FSCAN_NOT_STARTED = 0
 FSCAN_INITIAL_CONNECT = 1
@@ -96,6 +109,42 @@ FSCAN_FINAL_POLL = 100
 log = logging.getLogger(__name__)
 
 # Helper Functions
+def _set_udp_rcvbuf(sock):
+    # many devices broadcasting at the same time can overflow the default receive buffer
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDPRCVBUF)
+    except OSError:
+        log.debug('Unable to set UDP receive buffer size', exc_info=True)
+    log.debug('UDP receive buffer size is %r', sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+
+def _get_termcolors(color):
+    # the color strings never change, so only build them once for each setting
+    key = color is not False
+    if key not in _termcolors_cache:
+        _termcolors_cache[key] = TermColors( *tinytuya.termcolor(color) )
+    return _termcolors_cache[key]
+
+def _json_loads(data):
+    if ORJSONLIB:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _json_dump(data, fname):
+    # not orjson: it writes raw UTF-8 and only indents by 2, and load_snapshotfile() reads with the locale encoding
+    # write straight to a temp file instead of building the whole document as a str first, and only
+    #  replace the old file once that succeeds so a failed dump does not leave it truncated
+    tmpname = fname + '.tmp'
+    try:
+        with open(tmpname, "w") as outfile:
+            json.dump(data, outfile, indent=4)
+        os.replace(tmpname, fname)
+    except:
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+        raise
+
 def getmyIPaddr():
     # Fetch my IP address and assume /24 network
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -335,6 +384,15 @@ class DeviceDetect(object):
             self.close()
 
     def get_peer(self):
+        # a failed non-blocking connect() leaves the reason in SO_ERROR, so check that first
+        #  instead of provoking exceptions to find out
+        try:
+            err = self.sock.getsockopt( socket.SOL_SOCKET, socket.SO_ERROR )
+        except OSError:
+            err = 0
+        if err:
+            return self.connect_failed( err )
+
         try:
             # getpeername() blows up with "OSError: [Errno 107] Transport endpoint is
             # not connected" if the connection was refused
@@ -357,20 +415,9 @@ class DeviceDetect(object):
             # ugh, ConnectionResetError and ConnectionRefusedError are not available on python 2.7
             #except ConnectionResetError:
             except OSError as e:
-                if self.initial_connect_retries and e.errno == errno.ECONNRESET:
-                    # connected, but then closed
-                    self.initial_connect_retries -= 1
-                    if self.debug:
-                        print('Debug sock', self.ip, 'connection made but then closed, retrying')
-                    return False
-                elif e.errno == errno.ECONNRESET:
-                    if self.debug:
-                        print('Debug sock', self.ip, 'connection made but then closed and retry limit exceeded, giving up')
-                else:
-                    if self.debug:
-                        traceback.print_exception(e,e,None)
-                        print('Debug sock', self.ip, 'connection refused, not retrying')
-                    return None
+                if self.debug and e.errno != errno.ECONNRESET:
+                    traceback.print_exception(e,e,None)
+                return self.connect_failed( e.errno )
             except:
                 if self.debug:
                     print('Debug sock', self.ip, 'unhandled connection exception!')
@@ -381,6 +428,21 @@ class DeviceDetect(object):
             return False
         return addr
 
+    def connect_failed( self, err ):
+        # returns 'False' if the connection should be retried, 'None' if not
+        if err == errno.ECONNRESET:
+            if self.initial_connect_retries:
+                # connected, but then closed
+                self.initial_connect_retries -= 1
+                if self.debug:
+                    print('Debug sock', self.ip, 'connection made but then closed, retrying')
+            elif self.debug:
+                print('Debug sock', self.ip, 'connection made but then closed and retry limit exceeded, giving up')
+            return False
+        if self.debug:
+            print('Debug sock', self.ip, 'connection refused, not retrying')
+        return None
+
     def v34_negotiate_sess_key_start( self ):
         if self.debug:
             print('v3.4/5 trying key', self.ip, self.device.real_local_key)
@@ -963,6 +1025,11 @@ class PollDevice(DeviceDetect):
             self.close()
             return
 
+        if len(data) == 0:
+            # the device closed the connection, a dead socket stays readable forever
+            self.timeout()
+            return
+
         while len(data):
             try:
                 prefix_offset = data.find(tinytuya.PREFIX_BIN)
@@ -1051,8 +1118,12 @@ def _generate_ip(networks, verbose, term):
         if verbose:
             print(term.bold + '  Starting Scan for network %s%s' % (network, term.dim))
         # Loop through each host
-        for addr in ipaddress.IPv4Network(network):
-            yield str(addr)
+        # the addresses are generated from plain integers since creating an IPv4Address for
+        #  each one is slow for large networks
+        network = ipaddress.IPv4Network(network)
+        first_addr = int(network.network_address)
+        for i in range(network.num_addresses):
+            yield socket.inet_ntoa( struct.pack('>I', first_addr + i) )
 
 def _print_device_info( result, note, term, extra_message=None, verbose=True ):
     if not verbose:
@@ -1114,7 +1185,8 @@ def devices(verbose=False, scantime=None, color=True, poll=True, forcescan=False
         discover = True or False, when False, UDP broadcast packets will be ignored
         wantips = A list of IP addresses we want.  Scan will stop early if all are found
         wantids = A list of Device IDs we want.  Scan will stop early if all are found
-        snapshot = A dict of devices with IP addresses as keys.  These devices will be force-scanned
+        snapshot = A dict of devices with IP addresses as keys.  Devices with a known version and ID will be polled,
+                    the rest will be force-scanned
         assume_yes = True or False, do not prompt to confirm auto-detected network ranges
         tuyadevices = contents of devices.json, to prevent re-loading it if we already have it
         maxdevices = Stop scanning after this many devices are found.  0 for no limit
@@ -1133,16 +1205,8 @@ def devices(verbose=False, scantime=None, color=True, poll=True, forcescan=False
 
     """
     # Terminal formatting
-    termcolors = tinytuya.termcolor(color)
-    #(bold, subbold, normal, dim, alert, alertdim, cyan, red, yellow) = termcolors
-    term = TermColors( *termcolors )
-
-    # Lookup Tuya device info by (id) returning (name, key)
-    def tuyaLookup(deviceid):
-        for i in tuyadevices:
-            if "id" in i and i["id"] == deviceid:
-                return (i["name"], i["key"], i["mac"] if "mac" in i else "")
-        return ("", "", "")
+    #(bold, subbold, normal, dim, alert, alertdim, cyan, red, yellow) = tinytuya.termcolor(color)
+    term = _get_termcolors(color)
 
     havekeys = False
     if not tuyadevices:
@@ -1157,6 +1221,19 @@ def devices(verbose=False, scantime=None, color=True, poll=True, forcescan=False
             # No Device info
             pass
 
+    # Index devices.json by id so broadcasts do not need to search the whole list
+    tuyadevices_by_id = {}
+    for i in tuyadevices:
+        if "id" in i and i["id"] not in tuyadevices_by_id:
+            tuyadevices_by_id[i["id"]] = i
+
+    # Lookup Tuya device info by (id) returning (name, key, mac)
+    def tuyaLookup(deviceid):
+        if deviceid in tuyadevices_by_id:
+            i = tuyadevices_by_id[deviceid]
+            return (i["name"], i["key"], i["mac"] if "mac" in i else "")
+        return ("", "", "")
+
     if forcescan and len(tuyadevices) == 0:
         if discover:
             print(term.alert + 'Warning: Force-scan requires keys in %s but no keys were found.  Disabling force-scan.' % DEVICEFILE + term.normal)
@@ -1168,34 +1245,40 @@ def devices(verbose=False, scantime=None, color=True, poll=True, forcescan=False
         # Enable UDP listening broadcasting mode on UDP port 6666 - 3.1 Devices
         client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         client.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        _set_udp_rcvbuf(client)
         try:
             client.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         except AttributeError:
             # SO_REUSEPORT not available
             pass
         client.bind(("", UDPPORT))
+        client.setblocking(False)
         #client.settimeout(TIMEOUT)
 
         # Enable UDP listening broadcasting mode on encrypted UDP port 6667 - 3.3 Devices
         clients = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         clients.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        _set_udp_rcvbuf(clients)
         try:
             clients.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         except AttributeError:
             # SO_REUSEPORT not available
             pass
         clients.bind(("", UDPPORTS))
+        clients.setblocking(False)
         #clients.settimeout(TIMEOUT)
 
         # Enable UDP listening broadcasting mode on encrypted UDP port 7000 - App
         clientapp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         clientapp.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        _set_udp_rcvbuf(clientapp)
         try:
             clientapp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         except AttributeError:
             # SO_REUSEPORT not available
             pass
         clientapp.bind(("", UDPPORTAPP))
+        clientapp.setblocking(False)
     else:
         client = clients = clientapp = None
         # no broadcast and no force scan???
@@ -1228,13 +1311,17 @@ def devices(verbose=False, scantime=None, color=True, poll=True, forcescan=False
     broadcasted_devices = {}
     broadcast_messages = {}
     broadcasted_apps = {}
+    last_broadcast = {}
     devicelist = []
     read_socks = []
     write_socks = []
     spinnerx = 0
     spinner = "|/-\\|"
+    spinner_time = 0
     connect_this_round = []
     connect_next_round = []
+    snapshot_polls = []
+    snapshot_poll_delay = False
     ip_wantips = bool(wantips)
     ip_wantids = bool(wantids)
     ip_force_wants_end = False
@@ -1248,7 +1335,7 @@ def devices(verbose=False, scantime=None, color=True, poll=True, forcescan=False
     timeout_time = time.time() + 5
     scan_ips = None
     current_ip = None
-    need_sleep = 0.1
+    select_timeout = 0.1
     user_break_count = 0
     client_ip_broadcast_list = {}
     client_ip_broadcast_timer = 0
@@ -1313,7 +1400,14 @@ def devices(verbose=False, scantime=None, color=True, poll=True, forcescan=False
 
     if snapshot:
         for ip in snapshot:
-            networks.append( ip )
+            if snapshot[ip]['version'] and snapshot[ip]['gwId']:
+                # we already know enough to poll it, so queue it up instead of waiting for the force-scan to reach it
+                snapshot_polls.append( ip )
+            else:
+                networks.append( ip )
+        if discover and snapshot_polls:
+            # give the devices a chance to broadcast first, a broadcast replaces the (possibly stale) snapshot entry
+            snapshot_poll_delay = time.time() + 5
     else:
         snapshot = []
 
@@ -1339,7 +1433,7 @@ def devices(verbose=False, scantime=None, color=True, poll=True, forcescan=False
         addr = client_bcast_addrs[bcast]
         client_ip_broadcast_list[addr] = { 'broadcast': bcast }
 
-    while ip_scan_running or scan_end_time > time.time() or device_end_time > time.time() or connect_next_round:
+    while ip_scan_running or scan_end_time > time.time() or device_end_time > time.time() or connect_next_round or snapshot_polls:
         if client:
             read_socks = [client, clients, clientapp]
         else:
@@ -1348,15 +1442,14 @@ def devices(verbose=False, scantime=None, color=True, poll=True, forcescan=False
         write_socks = []
         all_socks = {}
         remove = []
-        connect_this_round = connect_next_round
-        connect_next_round = []
+        # (ip, connect_after) pairs, see below
+        connect_this_round = [i for i in connect_next_round if i[1] <= time.time()]
+        connect_next_round = [i for i in connect_next_round if i not in connect_this_round]
         device_end_time = 0
         devices_with_timers = ''
-        if timeout_time >= scan_end_time:
-            do_timeout = True
-        else:
-            do_timeout = timeout_time <= time.time()
-            if do_timeout: timeout_time = time.time() + 1.0 #connect_timeout
+        # device timeouts are held off for the first few seconds, after that each one fires at its own deadline
+        do_timeout = (timeout_time >= scan_end_time) or (timeout_time <= time.time())
+        next_deadline = time.time() + select_timeout
 
         for dev in devicelist:
             if dev.scanned and dev.ip not in scanned_devices:
@@ -1379,6 +1472,9 @@ def devices(verbose=False, scantime=None, color=True, poll=True, forcescan=False
                     #         devices_with_timers += ' ' + str(dev.ip) + ' ' + str(int(dev.timeo))
                     device_end_time = dev.timeo + 1.0
 
+                if not dev.remove:
+                    next_deadline = min( next_deadline, dev.timeo, dev.hard_time_limit )
+
             if not dev.sock:
                 continue
 
@@ -1393,7 +1489,9 @@ def devices(verbose=False, scantime=None, color=True, poll=True, forcescan=False
         for dev in remove:
             devicelist.remove(dev)
 
-        if show_timer:
+        # the loop runs as fast as packets arrive, so only redraw the spinner every select_timeout seconds
+        if show_timer and spinner_time <= time.time():
+            spinner_time = time.time() + select_timeout
             if scan_end_time > device_end_time:
                 end_time = int(scan_end_time - time.time())
                 if end_time < 0: end_time = 0
@@ -1407,7 +1505,7 @@ def devices(verbose=False, scantime=None, color=True, poll=True, forcescan=False
         try:
             if ip_scan_running:
                 # half-speed the spinner while force-scanning
-                need_sleep = 0.2
+                select_timeout = 0.2
                 # time out any sockets which have not yet connected
                 # no need to run this every single time through the loop
                 if ip_scan_delay:
@@ -1416,26 +1514,22 @@ def devices(verbose=False, scantime=None, color=True, poll=True, forcescan=False
                 if (not ip_scan_delay) and len(write_socks) < max_parallel:
                     ip_scan_delay = False
                     want = max_parallel - len(write_socks)
-                    # only open 10 at most during each pass through select()
-                    if want > 10: want = 10
+                    # limit how many are opened during each pass through select()
+                    if want > max_connects_per_pass: want = max_connects_per_pass
                     for i in range(want):
                         current_ip = next( scan_ips, None )
                         # all done!
                         if current_ip is None:
                             ip_scan_running = False
                             device_end_time = time.time() + connect_timeout + 1.0
-                            need_sleep = 0.1
+                            select_timeout = 0.1
                             break
                         else:
                             if current_ip in broadcasted_devices:
                                 continue
                             elif current_ip in snapshot and snapshot[current_ip]['version'] and snapshot[current_ip]['gwId']:
-                                ip = current_ip
-                                broadcasted_devices[ip] = PollDevice( ip, snapshot[current_ip], options, ip in debug_ips )
-                                broadcasted_devices[ip].connect()
-                                devicelist.append( broadcasted_devices[ip] )
-                                check_end_time = time.time() + connect_timeout
-                                if check_end_time > device_end_time: device_end_time = check_end_time
+                                # waiting in snapshot_polls
+                                continue
                             else:
                                 if current_ip in snapshot:
                                     dev = ForceScannedDevice( current_ip, snapshot[current_ip], options, current_ip in debug_ips )
@@ -1445,20 +1539,20 @@ def devices(verbose=False, scantime=None, color=True, poll=True, forcescan=False
                                 write_socks.append(dev.sock)
                                 all_socks[dev.sock] = dev
 
-                            # we slept here so adjust the loop sleep time accordingly
-                            time.sleep(0.02)
-                            need_sleep -= 0.02
-
-            if need_sleep > 0:
-                time.sleep( need_sleep )
+            # wait on the sockets instead of sleeping so packets are handled as soon as they arrive,
+            #  but wake up in time for the next device timeout
+            wait = select_timeout
+            if do_timeout:
+                wait = max( 0, min( wait, next_deadline - time.time() ) )
 
             if len(write_socks) > 0:
-                rd, wr, _ = select.select( read_socks, write_socks, [], 0 )
+                rd, wr, _ = select.select( read_socks, write_socks, [], wait )
             elif len(read_socks) > 0:
-                rd, _, _ = select.select( read_socks, [], [], 0 )
+                rd, _, _ = select.select( read_socks, [], [], wait )
                 wr = []
             else:
                 # not listening for broadcasts and no open sockets yet
+                time.sleep( wait )
                 rd = []
                 wr = []
         except KeyboardInterrupt as err:
@@ -1469,6 +1563,7 @@ def devices(verbose=False, scantime=None, color=True, poll=True, forcescan=False
             if user_break_count == 1:
                 ip_scan_running = False
                 scan_end_time = 0
+                snapshot_polls = []
             elif user_break_count == 2:
                 break
             else:
@@ -1500,115 +1595,142 @@ def devices(verbose=False, scantime=None, color=True, poll=True, forcescan=False
             else:
                 tgt_port = '???'
 
-            data, addr = sock.recvfrom(4048)
-            ip = addr[0]
-            result = b''
-            try:
-                result = tinytuya.decrypt_udp( data )
-                result = json.loads(result)
-                log.debug("Received valid UDP packet: %r", result)
-            except:
-                #traceback.print_exc()
-                if verbose:
-                    print(term.alertdim + "*  Unexpected payload from %r to port %r:%s %r (%r)\n" % (ip, tgt_port, term.normal, result, data))
-                log.debug("Invalid UDP Packet from %r port %r - %r", ip, tgt_port, data)
-                continue
+            # drain what is waiting instead of going back through select() for each packet, but not
+            #  forever: a flood of packets must not starve the TCP sockets, anything left is read next pass
+            for _ in range(max_datagrams_per_pass):
+                try:
+                    data, addr = sock.recvfrom(4048)
+                except BlockingIOError:
+                    break
+                ip = addr[0]
 
-            if ip_force_wants_end:
-                continue
+                # devices repeat the same broadcast every few seconds, skip decrypting and parsing it again
+                if last_broadcast.get( (ip, tgt_port) ) == data:
+                    continue
+                last_broadcast[(ip, tgt_port)] = data
 
-            if 'from' in result and result['from'] == 'app': #sock is clientapp:
-                if ip not in broadcasted_apps:
-                    broadcasted_apps[ip] = result
+                result = b''
+                try:
+                    result = tinytuya.decrypt_udp( data )
+                    result = _json_loads(result)
+                    log.debug("Received valid UDP packet: %r", result)
+                # bad length/padding/JSON (incl. UnicodeDecodeError) are ValueErrors, the rest come from unpacking a truncated or empty packet
+                except (ValueError, TypeError, IndexError, struct.error, tinytuya.DecodeError):
+                    #traceback.print_exc()
                     if verbose:
-                        print( term.alertdim + 'New Broadcast from App at ' + str(ip) + term.dim + ' - ' + str(result) + term.normal )
-                continue
+                        print(term.alertdim + "*  Unexpected payload from %r to port %r:%s %r (%r)\n" % (ip, tgt_port, term.normal, result, data))
+                    log.debug("Invalid UDP Packet from %r port %r - %r", ip, tgt_port, data)
+                    continue
 
-            if 'gwId' not in result:
-                if verbose:
-                    print(term.alertdim + "*  Payload missing required 'gwId' - from %r to port %r:%s %r (%r)\n" % (ip, tgt_port, term.normal, result, data))
-                log.debug("UDP Packet payload missing required 'gwId' - from %r port %r - %r", ip, tgt_port, data)
-                continue
+                if ip_force_wants_end:
+                    continue
 
-            # check to see if we have seen this device before and add to devices array
-            #if tinytuya.appenddevice(result, deviceslist) is False:
-            if ip not in broadcasted_devices:
-                (dname, dkey, mac) = tuyaLookup(result['gwId'])
-                result["name"] = dname
-                result["key"] = dkey
-                result["mac"] = mac
-
-                if 'id' not in result:
-                    result['id'] = result['gwId']
-
-                if verbose:
-                    broadcast_messages[ip] = term.alertdim + term.dim + 'New Broadcast from ' + str(ip) + ' / ' + str(mac) + ' ' + str(result) + term.normal
-                    # if False:
-                    #     print( data )
-                    #     print( result )
-                    #     print( broadcast_messages[ip] )
-
-                #if not mac and SCANLIBS:
-                #    a = time.time()
-                #    mac = get_mac_address(ip=ip, network_request=False)
-                #    b = time.time()
-                #    if verbose:
-                #        print('Discovered MAC', mac, 'in', (b-a))
-                #    if mac and mac != '00:00:00:00:00:00':
-                #        result["mac"] = mac
-
-                # 20-digit-long IDs are product_idx + MAC
-                if not mac and len(result['gwId']) == 20:
-                    try:
-                        mac = bytearray.fromhex( result['gwId'][-12:] )
-                        result["mac"] = '%02x:%02x:%02x:%02x:%02x:%02x' % tuple(mac)
-                    except:
-                        pass
+                if 'from' in result and result['from'] == 'app': #sock is clientapp:
+                    if ip not in broadcasted_apps:
+                        broadcasted_apps[ip] = result
+                        if verbose:
+                            print( term.alertdim + 'New Broadcast from App at ' + str(ip) + term.dim + ' - ' + str(result) + term.normal )
+                    continue
 
-                broadcasted_devices[ip] = PollDevice( ip, result, options, ip in debug_ips )
-                do_poll = False
+                if 'gwId' not in result:
+                    if verbose:
+                        print(term.alertdim + "*  Payload missing required 'gwId' - from %r to port %r:%s %r (%r)\n" % (ip, tgt_port, term.normal, result, data))
+                    log.debug("UDP Packet payload missing required 'gwId' - from %r port %r - %r", ip, tgt_port, data)
+                    continue
 
-                if poll:
-                    # v3.1 does not require a key for polling, but v3.2+ do
-                    if result['version'] != "3.1" and not dkey:
-                        broadcasted_devices[ip].message = "%s    No Stats for %s: DEVICE KEY required to poll for status%s" % (term.alertdim, ip, term.dim)
-                    elif user_break_count:
-                        broadcasted_devices[ip].message = "%s    No Stats for %s: User interrupted scan%s" % (term.alertdim, ip, term.dim)
-                    else:
-                        # open a connection and dump it into the select()
-                        do_poll = True
+                # check to see if we have seen this device before and add to devices array
+                #if tinytuya.appenddevice(result, deviceslist) is False:
+                if ip not in broadcasted_devices:
+                    (dname, dkey, mac) = tuyaLookup(result['gwId'])
+                    result["name"] = dname
+                    result["key"] = dkey
+                    result["mac"] = mac
 
-                if do_poll:
-                    # delay at least 100ms
-                    connect_next_round.append(ip)
-                else:
-                    broadcasted_devices[ip].close()
-
-                if ip in wantips:
-                    wantips.remove(ip)
-                if broadcasted_devices[ip].deviceinfo['gwId'] in wantids:
-                    wantids.remove( broadcasted_devices[ip].deviceinfo['gwId'] )
-                if maxdevices:
-                    maxdevices -= 1
-                    if maxdevices == 0:
-                        if verbose:
-                            print('Found all the devices we wanted, ending scan early')
-                        ip_wantips = False
-                        ip_wantids = False
-                        ip_force_wants_end = True
-                        scan_end_time = 0
-                        for dev in devicelist:
-                            if (not dev.remove) and (not dev.passive) and ((dev.timeo + 1.0) > device_end_time):
-                                device_end_time = dev.timeo + 1.0
-
-                for dev in devicelist:
-                    if dev.ip == ip:
-                        if verbose:
-                            print('Aborting force-scan for device', ip, 'due to received broadcast')
-                        dev.abort()
-                        break
+                    if 'id' not in result:
+                        result['id'] = result['gwId']
+
+                    if verbose:
+                        broadcast_messages[ip] = term.alertdim + term.dim + 'New Broadcast from ' + str(ip) + ' / ' + str(mac) + ' ' + str(result) + term.normal
+                        # if False:
+                        #     print( data )
+                        #     print( result )
+                        #     print( broadcast_messages[ip] )
+
+                    #if not mac and SCANLIBS:
+                    #    a = time.time()
+                    #    mac = get_mac_address(ip=ip, network_request=False)
+                    #    b = time.time()
+                    #    if verbose:
+                    #        print('Discovered MAC', mac, 'in', (b-a))
+                    #    if mac and mac != '00:00:00:00:00:00':
+                    #        result["mac"] = mac
+
+                    # 20-digit-long IDs are product_idx + MAC
+                    if not mac and len(result['gwId']) == 20:
+                        try:
+                            mac = bytearray.fromhex( result['gwId'][-12:] )
+                            result["mac"] = '%02x:%02x:%02x:%02x:%02x:%02x' % tuple(mac)
+                        except:
+                            pass
+
+                    broadcasted_devices[ip] = PollDevice( ip, result, options, ip in debug_ips )
+                    do_poll = False
+
+                    if poll:
+                        # v3.1 does not require a key for polling, but v3.2+ do
+                        if result['version'] != "3.1" and not dkey:
+                            broadcasted_devices[ip].message = "%s    No Stats for %s: DEVICE KEY required to poll for status%s" % (term.alertdim, ip, term.dim)
+                        elif user_break_count:
+                            broadcasted_devices[ip].message = "%s    No Stats for %s: User interrupted scan%s" % (term.alertdim, ip, term.dim)
+                        else:
+                            # open a connection and dump it into the select()
+                            do_poll = True
 
-        for ip in connect_this_round:
+                    if do_poll:
+                        # delay at least 100ms
+                        connect_next_round.append( (ip, time.time() + 0.1) )
+                    else:
+                        broadcasted_devices[ip].close()
+
+                    if ip in wantips:
+                        wantips.remove(ip)
+                    if broadcasted_devices[ip].deviceinfo['gwId'] in wantids:
+                        wantids.remove( broadcasted_devices[ip].deviceinfo['gwId'] )
+                    if maxdevices:
+                        maxdevices -= 1
+                        if maxdevices == 0:
+                            if verbose:
+                                print('Found all the devices we wanted, ending scan early')
+                            ip_wantips = False
+                            ip_wantids = False
+                            ip_force_wants_end = True
+                            scan_end_time = 0
+                            for dev in devicelist:
+                                if (not dev.remove) and (not dev.passive) and ((dev.timeo + 1.0) > device_end_time):
+                                    device_end_time = dev.timeo + 1.0
+
+                    for dev in devicelist:
+                        if dev.ip == ip:
+                            if verbose:
+                                print('Aborting force-scan for device', ip, 'due to received broadcast')
+                            dev.abort()
+                            break
+
+        # start the queued snapshot polls a few at a time so we never have too many sockets open
+        #  (all_socks includes any the force-scan opened this pass)
+        if snapshot_poll_delay and snapshot_poll_delay < time.time():
+            snapshot_poll_delay = False
+        if snapshot_polls and (not snapshot_poll_delay) and len(all_socks) < max_parallel:
+            want = max_parallel - len(all_socks)
+            if want > max_connects_per_pass: want = max_connects_per_pass
+            for ip in snapshot_polls[:want]:
+                # skip it if the device broadcasted while it was waiting
+                if ip not in broadcasted_devices:
+                    broadcasted_devices[ip] = PollDevice( ip, snapshot[ip], options, ip in debug_ips )
+                    connect_this_round.append( (ip, 0) )
+            snapshot_polls = snapshot_polls[want:]
+
+        for ip, _ in connect_this_round:
             broadcasted_devices[ip].connect()
             devicelist.append( broadcasted_devices[ip] )
             check_end_time = time.time() + connect_timeout
@@ -1892,10 +2014,8 @@ def save_snapshotfile(fname, data, term=None):
     for itm in data:
         devices.append( _snapshot_save_item(itm) )
     current = {'timestamp' : time.time(), 'devices' : devices}
-    output = json.dumps(current, indent=4)
     print(bold + "\n>> " + norm + "Saving device snapshot data to " + fname + "\n")
-    with open(fname, "w") as outfile:
-        outfile.write(output)
+    _json_dump(current, fname)
 
 # Scan Devices in snapshot.json
 def snapshot(color=True, assume_yes=False, skip_poll=None):
@@ -1907,8 +2027,7 @@ def snapshot(color=True, assume_yes=False, skip_poll=None):
         skip_poll = True or False, auto-answer 'no' to "Poll local devices?" (overrides assume_yes)
     """
     # Terminal formatting
-    termcolors = tinytuya.termcolor(color)
-    term = TermColors( *termcolors )
+    term = _get_termcolors(color)
 
     print(
         "\n%sTinyTuya %s(Tuya device scanner)%s [%s]\n"
@@ -1980,8 +2099,7 @@ def alldevices(color=True, scantime=None, forcescan=False, discover=True, assume
     """
     # Terminal formatting
     #(bold, subbold, normal, dim, alert, alertdim, cyan, red, yellow) = tinytuya.termcolor(color)
-    termcolors = tinytuya.termcolor(color)
-    term = TermColors( *termcolors )
+    term = _get_termcolors(color)
 
     print(
         "\n%sTinyTuya %s(Tuya device scanner)%s [%s]\n"
@@ -2018,8 +2136,7 @@ def alldevices(color=True, scantime=None, forcescan=False, discover=True, assume
     return
 
 def poll_and_display( tuyadevices, color=True, scantime=None, snapshot=False, forcescan=False, discover=True ): # pylint: disable=W0621
-    termcolors = tinytuya.termcolor(color)
-    term = TermColors( *termcolors )
+    term = _get_termcolors(color)
 
     by_id = [x['id'] for x in tuyadevices]
     # Scan network for devices and provide polling data